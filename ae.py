@@ -1,14 +1,56 @@
-import pickle
 from cv2 import SAMPLING_PROGRESSIVE_NAPSAC
-import tensorflow
-from keras.models import Model
-from keras.layers import Input, Conv2D, ReLU, BatchNormalization, Flatten, Dense, Reshape, Conv2DTranspose, Activation
-from keras import backend as K
+import tensorflow as tf
+from keras.models import Model, Sequential, load_model
+from keras.layers import Input, InputLayer, Conv2D, ReLU, BatchNormalization, Flatten, Dense, Reshape, Conv2DTranspose, Activation
+from keras import mixed_precision
 from keras.optimizers import Adam
-from keras.losses import MeanSquaredError
+from keras.metrics import Mean
+from keras.saving import register_keras_serializable
 import numpy as np
 import os
 
+@register_keras_serializable(package="autoencoder")
+class _AutoencoderModel(Model):
+    """
+    Functional model whose train step runs forward pass, mse loss and
+    backward pass together. compile(jit_compile=True) hands it to keras,
+    which wraps it in one XLA compiled tf.function per compile() and traces
+    it against the dataset's element_spec.
+    The reported loss is the mse averaged over the epoch, for both fit and evaluate.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loss_tracker = Mean(name="loss")
+
+    @property
+    def metrics(self):
+        # listed here so keras resets the tracker at the start of every epoch
+        return [self._loss_tracker]
+
+    def test_step(self, data):
+        x, y = data
+        y_pred = self(x, training=False)
+        self._loss_tracker.update_state(self._mse(y, y_pred))
+        return {"loss": self._loss_tracker.result()}
+
+    def _mse(self, y, y_pred):
+        return tf.reduce_mean(tf.square(tf.cast(y, y_pred.dtype) - y_pred))
+
+    def train_step(self, data):
+        x, y = data
+        with tf.GradientTape() as tape:
+            y_pred = self(x, training=True)
+            loss = self._mse(y, y_pred)
+            scaled_loss = loss
+            if isinstance(self.optimizer, mixed_precision.LossScaleOptimizer):
+                scaled_loss = self.optimizer.get_scaled_loss(loss)
+        gradients = tape.gradient(scaled_loss, self.trainable_variables)
+        if isinstance(self.optimizer, mixed_precision.LossScaleOptimizer):
+            gradients = self.optimizer.get_unscaled_gradients(gradients)
+        self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+        self._loss_tracker.update_state(loss)
+        return {"loss": self._loss_tracker.result()}
+
 class Autoencoder:
     """
     A deep convolutional architecture with mirrored encoder and decoder components.
@@ -21,16 +63,25 @@ class Autoencoder:
         self.conv_strides = conv_strides  # [1, 2, 2]
         self.latent_space_dim = latent_space_dim # 2
 
+        if mixed_precision.global_policy().name == "mixed_float16":
+            # Tensor Cores only kick in when the channel counts are multiples of 8
+            assert all(f % 8 == 0 for f in conv_filters), \
+                f"conv_filters must be multiples of 8 for mixed_float16, got {conv_filters}"
+
         self.encoder = None
         self.decoder = None
         self.model = None
         self._shape_before_bottleneck=None
         self._model_input = None
+        self._encode_function = None
+        self._decode_function = None
+        self._initial_weights = None
 
         #num of conv layers in architecture
         self._num_conv_layers=len(conv_filters)
 
         self._build()
+        self._build_inference_functions()
 
     def summary(self):
         self.encoder.summary()
@@ -38,54 +89,229 @@ class Autoencoder:
         self.model.summary()
 
     def compile(self, learning_rate):
-        optimizer = Adam(learning_rate=learning_rate)
-        mse_loss = MeanSquaredError()
-        self.model.compile(optimizer=optimizer, loss=mse_loss)
-
-    def train(self, x_train, batch_size, num_epochs):
-        self.model.fit(x_train, 
-                       x_train, 
-                       batch_size=batch_size, 
-                       epochs=num_epochs,
-                       shuffle=True)
+        # jit_compile fuses the adam update of all weights into one XLA kernel
+        optimizer = Adam(learning_rate=learning_rate, jit_compile=True)
+        # the model's own policy, the global one may have changed since it was
+        # built, e.g. when a sweep builds other models before training this one.
+        if self.model.dtype_policy.name == "mixed_float16":
+            # loss scaling keeps small fp16 gradients from underflowing to zero,
+            # bf16 has the fp32 exponent range so it does not need it
+            optimizer = mixed_precision.LossScaleOptimizer(optimizer)
+        # the mse loss is computed in _AutoencoderModel.train_step.
+        # jit_compile fuses the conv/relu/bn ops of each train step with XLA,
+        # the float32 sigmoid output layer keeps the loss out of fp16
+        self.model.compile(optimizer=optimizer, jit_compile=True)
+
+    def train(self, dataset, num_epochs):
+        """dataset is a batched tf.data.Dataset of (input, target) pairs."""
+        self.model.fit(dataset, epochs=num_epochs)
     
+    def snapshot_weights(self):
+        """Remembers the current weights as the ones reset() goes back to."""
+        self._initial_weights = self.model.get_weights()
+
+    def reset(self, learning_rate):
+        """
+        Puts the model back to the weights from snapshot_weights() and clears
+        the adam moments and iteration count. Unlike compiling again this keeps
+        the traced train step. Compiles the model if it was never compiled.
+        The LossScaleOptimizer's dynamic loss scale is left as it is, keras has
+        no public way to reset it.
+        """
+        if self._initial_weights is None:
+            raise ValueError("reset() needs a snapshot_weights() call first")
+        self.model.set_weights(self._initial_weights)
+        if getattr(self.model, "optimizer", None) is None:
+            self.compile(learning_rate)
+            return
+        optimizer = self.model.optimizer
+        if isinstance(optimizer, mixed_precision.LossScaleOptimizer):
+            optimizer = optimizer.inner_optimizer
+        # adam moments and the iteration count
+        for variable in optimizer.variables:
+            variable.assign(tf.zeros_like(variable))
+        optimizer.iterations.assign(0)
+        optimizer.learning_rate.assign(learning_rate)
+
     def save(self, save_folder="."):
+        # fold and check first, so a failing check leaves nothing half saved
+        fused_model = self.fold_bn_for_inference()
         self._create_folder_if_it_doesnt_exist(save_folder)
-        self._save_parameters(save_folder)
-        self._save_weights(save_folder)
+        self._save_model(save_folder)
+        self._save_fused_model(fused_model, save_folder)
+
+    def encode(self, x):
+        """
+        Maps a batch of images to float32 latent points. Any float input
+        dtype works, e.g. the float16 images load_mnist gives for fp16.
+        """
+        return self._encode_function(tf.cast(x, tf.float32))
+
+    def decode(self, z):
+        """Maps a batch of latent points back to float32 images."""
+        return self._decode_function(tf.cast(z, tf.float32))
+
+    def _build_inference_functions(self):
+        """
+        Traced once per instance because of the fixed input signatures, so
+        keep the Autoencoder around instead of calling encoder.predict.
+        Outputs are cast to float32 since the encoder computes in float16
+        under mixed_float16, so decode(encode(x)) round trips in any policy.
+        """
+        image_spec = tf.TensorSpec(shape=[None, *self.input_shape], dtype=tf.float32)
+        latent_spec = tf.TensorSpec(shape=[None, self.latent_space_dim], dtype=tf.float32)
+        self._encode_function = tf.function(
+            lambda x: tf.cast(self.encoder(x, training=False), tf.float32),
+            input_signature=[image_spec])
+        self._decode_function = tf.function(
+            lambda z: tf.cast(self.decoder(z, training=False), tf.float32),
+            input_signature=[latent_spec])
+
+    def export_tflite(self, path, representative_data):
+        """
+        Writes an int8 quantized TFLite model to path.
+        representative_data are a few training inputs used to calibrate
+        the activation ranges, only the first 100 are used.
+        The converted graph is a float32 copy with bn already folded, so no
+        mixed precision casts end up in it. Its input is int8, callers have to
+        quantize images with the scale and zero point from the interpreter's
+        get_input_details()[0]["quantization"]: q = x / scale + zero_point.
+        """
+        calibration_data = np.asarray(representative_data[:100], dtype=np.float32)
+        float32_model = self.fold_bn_for_inference(dtype="float32")
+        converter = tf.lite.TFLiteConverter.from_keras_model(float32_model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ((x[None],) for x in calibration_data)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        tflite_model = converter.convert()
+        with open(path, "wb") as f:
+            f.write(tflite_model)
 
     def load_weights(self, weights_path):
         self.model.load_weights(weights_path)
 
     @classmethod
     def load(cls, save_folder="."):
-        parameters_path = os.path.join(save_folder, "parameters.pkl")
-        with open(parameters_path, "rb") as f:
-            parameters = pickle.load(f)
-        autoencoder = Autoencoder(*parameters)
-        weights_path = os.path.join(save_folder, "weights.h5")
-        autoencoder.load_weights(weights_path)
+        """
+        Loads the whole saved graph, no rebuilding from parameters.
+        The constructor arguments are read back from the loaded layers.
+        """
+        model_path = os.path.join(save_folder, "model.keras")
+        model = load_model(model_path)
+        autoencoder = cls.__new__(cls)
+        autoencoder._set_model(model)
         return autoencoder
+
+    def _set_model(self, model):
+        self.model = model
+        self.encoder = model.get_layer("encoder")
+        self.decoder = model.get_layer("decoder")
+        conv_layers = [layer for layer in self.encoder.layers if isinstance(layer, Conv2D)]
+        self.input_shape = self.encoder.input_shape[1:]
+        self.conv_filters = tuple(layer.filters for layer in conv_layers)
+        self.conv_kernels = tuple(layer.kernel_size for layer in conv_layers)
+        self.conv_strides = tuple(layer.strides for layer in conv_layers)
+        self.latent_space_dim = self.encoder.output_shape[-1]
+        reshape_layer = next(layer for layer in self.decoder.layers if isinstance(layer, Reshape))
+        self._shape_before_bottleneck = reshape_layer.target_shape
+        self._model_input = self.model.input
+        self._num_conv_layers = len(conv_layers)
+        self._initial_weights = None
+        self._build_inference_functions()
     
     def _create_folder_if_it_doesnt_exist(self, folder):
         if not os.path.exists(folder):
             os.makedirs(folder)
     
-    def _save_parameters(self, save_folder):
-        parameters = [
-            self.input_shape,
-            self.conv_filters,
-            self.conv_kernels,
-            self.conv_strides,
-            self.latent_space_dim
-        ]
-        save_path = os.path.join(save_folder, "parameters.pkl")
-        with open(save_path, "wb") as f:
-            pickle.dump(parameters, f)
-    
-    def _save_weights(self, save_folder):
-        save_path = os.path.join(save_folder, "weights.h5")
-        self.model.save_weights(save_path)
+    def _save_model(self, save_folder):
+        save_path = os.path.join(save_folder, "model.keras")
+        self.model.save(save_path)
+
+    def _save_fused_model(self, fused_model, save_folder):
+        save_path = os.path.join(save_folder, "fused_model.keras")
+        fused_model.save(save_path)
+
+    def fold_bn_for_inference(self, dtype=None):
+        """
+        Returns a copy of the autoencoder for inference only, where each
+        batch normalization is folded into the conv layer right before it.
+        dtype overrides the dtype policy of every copied layer, e.g. "float32"
+        for a full precision copy of a mixed precision model.
+        """
+        self._check_bn_folding()
+        return self._copy_autoencoder(dtype, fold_bn=True, name="fused_autoencoder")
+
+    def _check_bn_folding(self):
+        """
+        Raises ValueError if folding changes the inference output. Compares
+        float32 copies with and without folding on a fixed batch, so half
+        precision rounding cannot trip it, only a wrong fold can.
+        """
+        reference_model = self._copy_autoencoder("float32", fold_bn=False, name="reference_autoencoder")
+        folded_model = self._copy_autoencoder("float32", fold_bn=True, name="folded_autoencoder")
+        x = tf.random.stateless_uniform((8, *self.input_shape), seed=(0, 0))
+        expected = reference_model(x, training=False)
+        actual = folded_model(x, training=False)
+        max_error = float(tf.reduce_max(tf.abs(expected - actual)))
+        tolerance = 1e-4
+        if max_error > tolerance:
+            raise ValueError(
+                f"Folding batch normalization changed the model output by {max_error}, "
+                f"more than the tolerance of {tolerance}")
+
+    def _copy_autoencoder(self, dtype, fold_bn, name):
+        encoder = self._copy_layers(self.encoder, dtype, fold_bn)
+        decoder = self._copy_layers(self.decoder, dtype, fold_bn)
+        model_input = encoder.input
+        model_output = decoder(encoder(model_input))
+        return Model(model_input, model_output, name=name)
+
+    def _copy_layers(self, model, dtype=None, fold_bn=True):
+        """Rebuilds a chain of layers, with fold_bn skipping every bn that follows a conv."""
+        layers = [layer for layer in model.layers if not isinstance(layer, InputLayer)]
+        model_input = Input(shape=model.input_shape[1:])
+        x = model_input
+        layer_index = 0
+        while layer_index < len(layers):
+            layer = layers[layer_index]
+            next_layer = layers[layer_index + 1] if layer_index + 1 < len(layers) else None
+            if fold_bn and isinstance(layer, Conv2D) and isinstance(next_layer, BatchNormalization):
+                new_layer, weights = self._fold_conv_bn(layer, next_layer, dtype)
+                layer_index += 2
+            else:
+                config = layer.get_config()
+                if dtype is not None:
+                    config["dtype"] = dtype
+                new_layer = layer.__class__.from_config(config)
+                weights = layer.get_weights()
+                layer_index += 1
+            x = new_layer(x)
+            new_layer.set_weights(weights)
+        return Model(model_input, x, name=model.name)
+
+    def _fold_conv_bn(self, conv_layer, bn_layer, dtype=None):
+        """
+        bn(conv(x)) = gamma * (W*x + b - mean) / sqrt(var + eps) + beta
+        so W' = W * scale and b' = (b - mean) * scale + beta.
+        """
+        gamma, beta, mean, variance = bn_layer.get_weights()
+        scale = gamma / np.sqrt(variance + bn_layer.epsilon)
+        weights = conv_layer.get_weights()
+        kernel = weights[0]
+        bias = weights[1] if conv_layer.use_bias else np.zeros_like(mean)
+        # Conv2D kernels are [h, w, in, out], Conv2DTranspose kernels are [h, w, out, in]
+        if isinstance(conv_layer, Conv2DTranspose):
+            kernel = kernel * scale[:, np.newaxis]
+        else:
+            kernel = kernel * scale
+        bias = (bias - mean) * scale + beta
+        config = conv_layer.get_config()
+        config["use_bias"] = True
+        if dtype is not None:
+            config["dtype"] = dtype
+        folded_layer = conv_layer.__class__.from_config(config)
+        return folded_layer, [kernel, bias]
 
     def _build(self):
         self._build_encoder()
@@ -95,82 +321,87 @@ class Autoencoder:
     def _build_autoencoder(self):
         model_input=self._model_input
         model_output = self.decoder(self.encoder(model_input))
-        self.model = Model(model_input, model_output)
+        self.model = _AutoencoderModel(model_input, model_output)
 
     def _build_decoder(self):
-        decoder_input = self._add_decoder_input()
-        dense_layer = self._add_dense_layer(decoder_input)
-        reshape_layer = self._add_reshape_layer(dense_layer)
-        conv_transpose_layer = self._add_conv_transpose_layers(reshape_layer)
-        decoder_output = self._add_decoder_output(conv_transpose_layer)
-        self.decoder = Model(decoder_input, decoder_output, name="decoder")
+        self.decoder = Sequential([
+            self._make_decoder_input(),
+            self._make_dense_layer(),
+            self._make_reshape_layer(),
+            *self._make_conv_transpose_layers(),
+            *self._make_decoder_output(),
+        ], name="decoder")
     
-    def _add_decoder_input(self):
+    def _make_decoder_input(self):
         return Input(shape=self.latent_space_dim, name="decoder_input")
     
-    def _add_dense_layer(self, decoder_input):
+    def _make_dense_layer(self):
         num_neurons = np.prod(self._shape_before_bottleneck) # [4, 4, 32] -> 
-        dense_layer = Dense(num_neurons, name="decoder_dense")(decoder_input)
-        return dense_layer
+        return Dense(num_neurons, name="decoder_dense")
     
-    def _add_reshape_layer(self, dense_layer):
-        return Reshape(self._shape_before_bottleneck)(dense_layer)
+    def _make_reshape_layer(self):
+        return Reshape(self._shape_before_bottleneck)
     
-    def _add_conv_transpose_layers(self, x):
-        """Add conv transpose blocks."""
-        #loop through all the conv layers in reverse order and stop at the 
-        #first layer
-        for layer_index in reversed(range(self._num_conv_layers)):
-            #[0, 1, 2] -> [2, 1, 0]
-            x = self._add_conv_transpose_layer(layer_index, x)
-        return x
+    def _make_conv_transpose_layers(self):
+        """Creates all conv transpose blocks in decoder, as one flat list of layers."""
+        #go through all the conv layers in reverse order and stop at the 
+        #first layer: [0, 1, 2] -> [2, 1, 0]
+        return [layer
+                for layer_index in reversed(range(self._num_conv_layers))
+                for layer in self._make_conv_transpose_layer(layer_index)]
     
-    def _add_conv_transpose_layer(self, layer_index, x):
+    def _make_conv_transpose_layer(self, layer_index):
         layer_num = self._num_conv_layers - layer_index
         conv_transpose_layer = Conv2DTranspose(
             filters=self.conv_filters[layer_index], # [24, 24, 1]
             kernel_size=self.conv_kernels[layer_index],
             strides=self.conv_strides[layer_index],
             padding="same",
+            data_format="channels_last",
+            # bn right after the conv subtracts the mean, so a bias would be wasted
+            use_bias=False,
             name=f"dcoder_conv_transpose_layer_{layer_num}"
         )
-        x = conv_transpose_layer(x)
-        x = ReLU(name=f"decoder_relu_{layer_num}")(x)
-        x = BatchNormalization(name=f"decoder_bn_{layer_num}")(x)
-        return x
+        return [
+            conv_transpose_layer,
+            BatchNormalization(name=f"decoder_bn_{layer_num}"),
+            ReLU(name=f"decoder_relu_{layer_num}"),
+        ]
 
-    def _add_decoder_output(self, x):
+    def _make_decoder_output(self):
         conv_transpose_layer = Conv2DTranspose(
             filters=1,
             kernel_size=self.conv_kernels[0],
             strides =self.conv_strides[0],
             padding="same",
+            data_format="channels_last",
             name=f"decoder_conv_transpose_layer_{self._num_conv_layers}"
         )
-        x = conv_transpose_layer(x)
-        output_layer = Activation("sigmoid", name="sigmoid_layer")(x)
-        return output_layer
+        # keep the output in float32 so the loss is numerically stable under mixed precision
+        output_layer = Activation("sigmoid", dtype="float32", name="sigmoid_layer")
+        return [conv_transpose_layer, output_layer]
 
     def _build_encoder(self):
-        encoder_input = self._add_encoder_input()
-        conv_layers = self._add_conv_layers(encoder_input)
-        bottleneck = self._add_bottleneck(conv_layers)
-        self._model_input = encoder_input
-        self.encoder=Model(encoder_input, bottleneck, name="encoder") #input and output and name
+        self.encoder = Sequential([
+            self._make_encoder_input(),
+            *self._make_conv_layers(),
+        ], name="encoder")
+        self._add_bottleneck(self.encoder)
+        self._model_input = self.encoder.input
 
-    def _add_encoder_input(self):
+    def _make_encoder_input(self):
         return Input(shape=self.input_shape, name="encoder_input")
     
-    def _add_conv_layers(self, encoder_input):
-        """Creates all convolutional blocks in encoder."""
-        x = encoder_input
-        for layer_index in range(self._num_conv_layers):
-            x = self._add_conv_layer(layer_index, x)
-        return x
+    def _make_conv_layers(self):
+        """Creates all convolutional blocks in encoder, as one flat list of layers."""
+        return [layer
+                for layer_index in range(self._num_conv_layers)
+                for layer in self._make_conv_layer(layer_index)]
 
-    def _add_conv_layer(self, layer_index, x):
-        """Adds a convolutional block to a graph of layers,
-        consisting of conv2d + ReLU + batch normalization.
+    def _make_conv_layer(self, layer_index):
+        """Creates a convolutional block,
+        consisting of conv2d + batch normalization + ReLU.
+        bn sits right after the conv so it can be folded into it for inference.
         """
         layer_number = layer_index+1
         conv_layer = Conv2D(
@@ -178,27 +409,28 @@ class Autoencoder:
             kernel_size=self.conv_kernels[layer_index],
             strides = self.conv_strides[layer_index],
             padding="same",
+            data_format="channels_last",
+            use_bias=False,
             name=f"encoder_conv_layer_{layer_number}"
         )
-        x = conv_layer(x)
-        x = ReLU(name=f"encoder_relu_{layer_number}")(x)
-        x = BatchNormalization(name=f"encoder_bn_{layer_number}")(x)
-
-        return x
+        return [
+            conv_layer,
+            BatchNormalization(name=f"encoder_bn_{layer_number}"),
+            ReLU(name=f"encoder_relu_{layer_number}"),
+        ]
     
-    def _add_bottleneck(self,x):
+    def _add_bottleneck(self, encoder):
         """
         Flatten data and add battleneck (Dense layer).
         """
-        self._shape_before_bottleneck = K.int_shape(x)[1:] # [2 batchsize (NOT needed), 7 width, 7 height, 32 channels]
-        x = Flatten()(x)
-        x = Dense(self.latent_space_dim, name="encoder_output")(x)
-        return x
+        self._shape_before_bottleneck = tuple(encoder.output.shape[1:]) # [2 batchsize (NOT needed), 7 width, 7 height, 32 channels]
+        encoder.add(Flatten())
+        encoder.add(Dense(self.latent_space_dim, name="encoder_output"))
     
 if __name__=="__main__":
     autoencoder = Autoencoder(
         input_shape=(28,28,1),
-        conv_filters=(38,64,64,64),
+        conv_filters=(40,64,64,64),
         conv_kernels=(3, 3, 3, 3),
         conv_strides=(1, 2, 2, 1),
         latent_space_dim=2
@@ -1,11 +1,27 @@
+import math
 from ae import Autoencoder
 from keras.datasets import mnist
+from keras import mixed_precision
 import tensorflow as tf
+import numpy as np
 
-LEARNING_RATE = 0.0005
-BATCH_SIZE = 32
+# batch size is 8x the original 32, fp16 activations leave room for it.
+# learning rate is scaled by sqrt(8), gentler than the linear rule for a small net
+BATCH_SIZE = 256
+LEARNING_RATE = 0.0005 * math.sqrt(BATCH_SIZE / 32)
 EPOCHS = 20
 
+# fp16 needs Volta or newer GPUs, bf16 needs Ampere (A100 etc) or a TPU
+PRECISION_POLICIES = {
+    "fp32": "float32",
+    "fp16": "mixed_float16",
+    "bf16": "mixed_bfloat16",
+}
+
+# fp32 convs and matmuls run on the TF32 Tensor Core path, only has an effect
+# on Ampere or newer GPUs (A100, A10, L4) and mainly matters for precision="fp32"
+tf.config.experimental.enable_tensor_float_32_execution(True)
+
 # Check if GPU is available
 physical_devices = tf.config.list_physical_devices('GPU')
 if len(physical_devices) > 0:
@@ -14,17 +30,62 @@ if len(physical_devices) > 0:
 else:
     print("GPU is not available, training will use the CPU")
 
-def load_mnist():
+# fp16 on a CPU is emulated and much slower than fp32
+PRECISION = "fp16" if len(physical_devices) > 0 else "fp32"
+
+def load_mnist(precision="fp32"):
+    """
+    Returns the images as (N, 28, 28, 1) tensors, normalized once up front
+    so the pipeline never recasts them. They are stored as float16 for
+    precision="fp16" and float32 otherwise, float16 is not the bf16 compute
+    dtype and is poorly supported on TPUs.
+    """
     (x_train, y_train), (x_test, y_test) = mnist.load_data()
+    dtype = np.float16 if precision == "fp16" else np.float32
 
-    x_train = x_train.astype("float32")/255 #normalize it to between 0 and 1
-    x_train = x_train.reshape(x_train.shape + (1,))
-    x_test = x_test.astype("float32")/255 #normalize it to between 0 and 1
-    x_test = x_test.reshape(x_test.shape + (1,))
+    x_train = tf.constant(normalize(x_train, dtype))
+    x_test = tf.constant(normalize(x_test, dtype))
 
     return x_train, y_train, x_test, y_test
 
-def train(x_train, learning_rate, batch_size, epochs):
+def normalize(images, dtype):
+    """
+    Scales uint8 images to between 0 and 1 and adds the channel axis,
+    in a single pass that writes straight into the output array.
+    """
+    normalized = np.empty(images.shape + (1,), dtype=dtype)
+    np.multiply(images.reshape(images.shape + (1,)), dtype(1/255), out=normalized)
+    return normalized
+
+def make_dataset(x_train, batch_size):
+    """
+    Keeps the normalized images in memory, reshuffles every epoch and
+    prefetches the next batch while the current one is being trained on,
+    straight onto the GPU when there is one.
+    """
+    options = tf.data.Options()
+    options.deterministic = False
+    options.experimental_optimization.map_and_batch_fusion = True
+    dataset = tf.data.Dataset.from_tensor_slices((x_train, x_train))
+    dataset = dataset.cache()
+    dataset = dataset.shuffle(10000, reshuffle_each_iteration=True)
+    # any map() added here should go after batch() so it runs on whole batches
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.with_options(options)
+    if len(physical_devices) > 0:
+        # keeps the next batches in GPU memory, so no host to device copy per step.
+        # prefetch_to_device has to be the last transformation in the pipeline
+        return dataset.apply(tf.data.experimental.prefetch_to_device('/GPU:0', buffer_size=tf.data.AUTOTUNE))
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+def build_autoencoder(precision=PRECISION):
+    """
+    precision is one of "fp32", "fp16" or "bf16".
+    fp16 and bf16 compute in half precision with fp32 weights. bf16 skips
+    loss scaling but only runs fast on Ampere GPUs (A100 etc) and TPUs.
+    """
+    # the policy has to be set before the layers are created
+    mixed_precision.set_global_policy(PRECISION_POLICIES[precision])
     autoencoder = Autoencoder(
         input_shape=(28,28,1),
         conv_filters=(32,64,64,64),
@@ -32,13 +93,34 @@ def train(x_train, learning_rate, batch_size, epochs):
         conv_strides=(1, 2, 2, 1),
         latent_space_dim=2
     )
+    autoencoder.snapshot_weights()
     autoencoder.summary()
-    autoencoder.compile(learning_rate)
-    autoencoder.train(x_train, batch_size, epochs)
+    return autoencoder
+
+def train(x_train, learning_rate, batch_size, epochs, autoencoder=None, precision=None):
+    """
+    Pass in an autoencoder from build_autoencoder to reuse it across calls,
+    e.g. in a sweep. Its traced graphs are kept, but the weights and the
+    adam state go back to their initial values before every call. Under fp16
+    the dynamic loss scale carries over from the previous call, so runs are
+    only independent up to which early steps get skipped for overflowing.
+    precision defaults to PRECISION for a new autoencoder, for a passed in
+    one it has to match the policy it was built with.
+    """
+    if autoencoder is None:
+        autoencoder = build_autoencoder(precision or PRECISION)
+    elif precision is not None and autoencoder.model.dtype_policy.name != PRECISION_POLICIES[precision]:
+        raise ValueError(
+            f"precision {precision!r} does not match the autoencoder's "
+            f"{autoencoder.model.dtype_policy.name!r} policy, build a new one instead")
+    autoencoder.reset(learning_rate)
+    dataset = make_dataset(x_train, batch_size)
+    autoencoder.train(dataset, epochs)
     return autoencoder
 
 if __name__ == "__main__":
-    x_train, _, _, _ = load_mnist()
-    autoencoder = train(x_train[:500], LEARNING_RATE, BATCH_SIZE, EPOCHS)
+    x_train, _, _, _ = load_mnist(PRECISION)
+    autoencoder = build_autoencoder(PRECISION)
+    autoencoder = train(x_train[:500], LEARNING_RATE, BATCH_SIZE, EPOCHS, autoencoder)
     autoencoder.save("model")
     autoencoder2 = Autoencoder.load("model")
\ No newline at end of file